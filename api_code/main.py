@@ -1,26 +1,32 @@
 import os
+import asyncio
+import concurrent.futures
 import logging
-import random
-import string
+import secrets
 import shutil
-import psycopg2
-import psycopg2.extras
+import time
+import asyncpg
+import orjson
 import bcrypt
 import re
 import mercadopago
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.staticfiles import StaticFiles 
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query, Response
+from fastapi.responses import ORJSONResponse
+from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
-from datetime import date, datetime, timedelta
+from pydantic import BaseModel, ConfigDict, EmailStr
+from typing import Optional, List, Literal
+from datetime import date, datetime
 from fastapi.middleware.cors import CORSMiddleware
+from anyio import to_thread
 
 # ==========================================
 # 1. CONFIGURACIÓN
 # ==========================================
 log = logging.getLogger("uvicorn")
 POSTGRES_URL = os.environ.get("POSTGRES_URL")
+# Con PgBouncer en modo transacción el cache de prepared statements por conexión no aplica
+PGBOUNCER = os.environ.get("PGBOUNCER", "0") == "1"
 db_connections = {}
 
 # Leer Token
@@ -29,30 +35,52 @@ mp_token = os.environ.get("MP_ACCESS_TOKEN")
 # URL del frontend (usada en las back_urls de Mercado Pago)
 FRONTEND_URL = os.environ.get("FRONTEND_URL", "https://servicios-api-4zmt.onrender.com")
 
+# Orígenes permitidos para CORS (lista separada por comas; default: el frontend)
+CORS_ORIGINS = os.environ.get("CORS_ORIGINS", FRONTEND_URL).split(",")
+
 # Verificación de Seguridad
 if not mp_token:
     print("\n⚠️  ADVERTENCIA: No se encontró MP_ACCESS_TOKEN en las variables de entorno.")
     print("⚠️  La API arrancará, pero los pagos fallarán.\n")
     sdk = None # Evita que explote al inicio
+    mp_preference = None
 else:
     try:
         sdk = mercadopago.SDK(mp_token)
+        # Cliente de preferencias cacheado: sdk.preference() construye un objeto nuevo cada vez
+        mp_preference = sdk.preference()
         print("✅ Mercado Pago SDK inicializado correctamente.")
     except Exception as e:
         print(f"❌ Error al iniciar Mercado Pago: {e}")
         sdk = None
+        mp_preference = None
 
 
 UPLOAD_DIR = "uploads"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
+# Buffer de copia de 1 MiB (el default de 16 KiB genera muchísimos syscalls por imagen)
+UPLOAD_BUFSIZE = 1024 * 1024
+
+# Regex de limpieza de nombres compilada una sola vez
+SANITIZE_RE = re.compile(r'[^a-zA-Z0-9_.-]')
+
+# Costo de bcrypt configurable para ajustarlo al hardware
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
+# Pool de procesos para bcrypt (~200ms de CPU por hash; no debe bloquear el event loop)
+bcrypt_pool = None
+
 # ==========================================
 # 2. MODELOS DE DATOS (Pydantic)
 # ==========================================
 
 # --- AUTH & REGISTRO ---
 class RegistroCliente(BaseModel):
+    # extra='ignore': no fallar (ni validar de más) si el frontend manda campos sobrantes
+    model_config = ConfigDict(extra='ignore')
+
     nombre: str
     apellidos: str
     correo_electronico: EmailStr
@@ -78,6 +106,8 @@ class SolicitudPago(BaseModel):
     propuesta_id: str
 
 class RegistroTrabajador(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
     nombre: str
     apellidos: str
     correo_electronico: EmailStr
@@ -158,71 +188,181 @@ class CalificarServicio(BaseModel):
 # --- ADMIN ---
 class AccionAdmin(BaseModel):
     usuario_id: str
-    accion: str
+    accion: Literal["validar", "bloquear", "desbloquear", "borrar"]
     dias_bloqueo: Optional[int] = 0
 
-    # --- NUEVO MODELO PAGO ---
-class SolicitudPago(BaseModel):
-    titulo: str
-    precio: float
-    servicio_id: str
-    propuesta_id: str
-    trabajador_id: str
-
 # ==========================================
 # 3. HELPERS
 # ==========================================
 def encriptar_password(password_plana: str) -> str:
     password_bytes = password_plana[:72].encode('utf-8')
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password_bytes, salt)
     return hashed.decode('utf-8')
 
 def generar_codigo_verificacion():
-    return ''.join(random.choices(string.digits, k=6))
+    # secrets: una sola llamada a getrandom(2) y además impredecible
+    return f"{secrets.randbelow(1_000_000):06d}"
 
 def verificar_password(password_plana: str, password_hash: str) -> bool:
     password_bytes = password_plana[:72].encode('utf-8')
     hash_bytes = password_hash.encode('utf-8')
     return bcrypt.checkpw(password_bytes, hash_bytes)
 
+# Ventana de intentos fallidos por correo: bajo una ráfaga de credenciales inválidas
+# (reintentos, credential stuffing) respondemos 429 antes de pagar bcrypt otra vez
+LOGIN_MAX_INTENTOS = 10
+LOGIN_VENTANA_SEG = 60
+_intentos_login = {}  # correo -> (contador, inicio_ventana)
+
+def login_bloqueado(correo: str) -> bool:
+    intento = _intentos_login.get(correo)
+    if not intento: return False
+    contador, inicio = intento
+    if time.time() - inicio > LOGIN_VENTANA_SEG:
+        del _intentos_login[correo]
+        return False
+    return contador >= LOGIN_MAX_INTENTOS
+
+def login_fallido(correo: str):
+    if len(_intentos_login) > 10_000:  # no crecer sin límite
+        ahora = time.time()
+        for k in [k for k, (_, t) in _intentos_login.items() if ahora - t > LOGIN_VENTANA_SEG]: del _intentos_login[k]
+    contador, inicio = _intentos_login.get(correo, (0, time.time()))
+    _intentos_login[correo] = (contador + 1, inicio)
+
+# Versiones async: corren bcrypt en el pool de procesos para no congelar el event loop
+async def encriptar_password_async(password_plana: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(bcrypt_pool, encriptar_password, password_plana)
+
+async def verificar_password_async(password_plana: str, password_hash: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(bcrypt_pool, verificar_password, password_plana, password_hash)
+
+# --- QUERIES CALIENTES (texto fijo para que el cache de prepared statements acierte) ---
+LOGIN_SQL = """
+    SELECT u.id, u.nombre, u.password_hash, u.activo, u.es_admin, u.bloqueado_hasta,
+           (dt.usuario_id IS NOT NULL) AS es_trabajador
+    FROM usuarios u
+    LEFT JOIN detalles_trabajador dt ON dt.usuario_id = u.id
+    WHERE u.correo_electronico = $1
+"""
+
+FEED_SQL = """
+    SELECT s.id, s.titulo, s.descripcion, s.precio_estimado, s.fecha_programada, s.direccion_texto, s.foto_evidencia_url,
+           c.nombre as categoria, u.nombre as cliente_nombre
+    FROM servicios s
+    JOIN categorias_oficios c ON s.categoria_id = c.id
+    JOIN usuarios u ON s.cliente_id = u.id
+    WHERE s.estado = 'SOLICITADO'
+    ORDER BY s.fecha_solicitud DESC LIMIT 20
+"""
+
+SERVICIOS_CLIENTE_SQL = """
+    SELECT s.id, s.titulo, s.estado, s.fecha_solicitud, c.nombre as categoria,
+           COALESCE(p.n, 0) as num_propuestas
+    FROM servicios s
+    JOIN categorias_oficios c ON s.categoria_id = c.id
+    LEFT JOIN (SELECT servicio_id, COUNT(*) AS n FROM propuestas GROUP BY servicio_id) p
+      ON p.servicio_id = s.id
+    WHERE s.cliente_id = $1
+    ORDER BY s.fecha_solicitud DESC
+"""
+
+PROPUESTAS_SQL = """
+    SELECT p.id, p.precio_oferta, p.mensaje, p.trabajador_id,
+           u.nombre, u.apellidos, u.foto_perfil_url, u.telefono,
+           dt.calificacion_promedio, dt.total_evaluaciones,
+           dt.anios_experiencia, dt.descripcion_bio
+    FROM propuestas p
+    JOIN usuarios u ON p.trabajador_id = u.id
+    JOIN detalles_trabajador dt ON u.id = dt.usuario_id
+    WHERE p.servicio_id = $1
+    ORDER BY p.precio_oferta ASC
+"""
+
+PERFIL_TRAB_SQL = """
+    SELECT u.nombre, u.apellidos, u.telefono, u.foto_perfil_url,
+           dt.descripcion_bio, dt.anios_experiencia, dt.tarifa_hora_estimada,
+           dt.calificacion_promedio, dt.total_evaluaciones, dt.validado_por_admin,
+           dt.foto_ine_frente_url, dt.foto_ine_reverso_url, dt.antecedentes_penales_url
+    FROM usuarios u
+    JOIN detalles_trabajador dt ON u.id = dt.usuario_id
+    WHERE u.id = $1
+"""
+
+async def init_conexion(conn: asyncpg.Connection):
+    # Codecs de tipos: numeric -> float y uuid -> str directo en el driver,
+    # así los endpoints no tienen que convertir fila por fila en Python
+    await conn.set_type_codec('numeric', encoder=str, decoder=float, schema='pg_catalog', format='text')
+    await conn.set_type_codec('uuid', encoder=str, decoder=str, schema='pg_catalog', format='text')
+
+async def crear_pool() -> asyncpg.Pool:
+    # Pool asíncrono: muchas queries concurrentes en vez de una sola conexión compartida.
+    # statement_cache_size: Postgres prepara cada query una sola vez por conexión.
+    return await asyncpg.create_pool(
+        POSTGRES_URL, min_size=10, max_size=50,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=0 if PGBOUNCER else 500,
+        init=init_conexion
+    )
+
+async def get_pool() -> asyncpg.Pool:
+    pool = db_connections.get("pool")
+    if pool is None:
+        # Si Postgres no estaba listo al arrancar, reintentamos aquí
+        try:
+            pool = await crear_pool()
+            db_connections["pool"] = pool
+        except Exception as e:
+            log.error(f"❌ Sin conexión a Postgres: {e}")
+            raise HTTPException(503, "Sin BD")
+    return pool
+
 # ==========================================
 # 4. LIFESPAN & APP
 # ==========================================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global bcrypt_pool
     log.info("🚀 Iniciando API...")
+    bcrypt_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+    # Los endpoints `def` restantes (Mercado Pago) van al threadpool de anyio;
+    # subimos el límite default de 40 para que no hagan cola bajo carga
+    to_thread.current_default_thread_limiter().total_tokens = 200
     try:
-        pg_conn = psycopg2.connect(POSTGRES_URL, cursor_factory=psycopg2.extras.DictCursor)
-        db_connections["pg_conn"] = pg_conn
-        
+        pool = await crear_pool()
+        db_connections["pool"] = pool
+
         # Admin por defecto
-        with pg_conn.cursor() as cur:
-            pass_admin = encriptar_password("admin123")
-            cur.execute("""
-                INSERT INTO usuarios (nombre, apellidos, correo_electronico, password_hash, telefono, es_admin, activo, fecha_nacimiento)
-                VALUES ('Super', 'Admin', 'admin@sistema.com', %s, '000', TRUE, TRUE, '2000-01-01')
-                ON CONFLICT (correo_electronico) DO NOTHING
-            """, (pass_admin,))
-            pg_conn.commit()
+        pass_admin = encriptar_password("admin123")
+        await pool.execute("""
+            INSERT INTO usuarios (nombre, apellidos, correo_electronico, password_hash, telefono, es_admin, activo, fecha_nacimiento)
+            VALUES ('Super', 'Admin', 'admin@sistema.com', $1, '000', TRUE, TRUE, '2000-01-01')
+            ON CONFLICT (correo_electronico) DO NOTHING
+        """, pass_admin)
         log.info("✅ Postgres Conectado.")
     except Exception as e:
-        if 'pg_conn' in locals() and pg_conn: pg_conn.rollback()
         log.error(f"❌ Error al iniciar Postgres: {e}")
     yield
-    if db_connections.get("pg_conn"):
-        db_connections["pg_conn"].close()
-
-app = FastAPI(lifespan=lifespan)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+    if db_connections.get("pool"):
+        await db_connections["pool"].close()
+    bcrypt_pool.shutdown()
+
+# orjson serializa en C (datetime, UUID y Decimal nativos) — mucho más rápido que json.dumps
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# En producción /uploads lo sirve nginx con sendfile (ver nginx/uploads.conf);
+# el mount de Python queda para desarrollo o deploys de un solo proceso
+if os.environ.get("SERVE_UPLOADS", "1") == "1":
+    app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# Ya no "*": allow_credentials=True con comodín ni siquiera es CORS válido
+app.add_middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor"])
 
 # ==========================================
 # 5. ENDPOINTS: GENERAL & AUTH
 # ==========================================
 
 @app.get("/")
-def read_root(): return {"mensaje": "API ISF Funcionando"}
+async def read_root(): return {"mensaje": "API ISF Funcionando"}
 
 
 # --- UPLOAD CORREGIDO (Sanitizar Nombres) ---
@@ -230,78 +370,93 @@ def read_root(): return {"mensaje": "API ISF Funcionando"}
 async def subir_imagen(file: UploadFile = File(...)):
     try:
         # 1. Limpiar nombre: reemplazar espacios y caracteres raros por guion bajo
-        nombre_limpio = re.sub(r'[^a-zA-Z0-9_.-]', '_', file.filename)
-        
-        # 2. Crear nombre único
-        nombre_archivo = f"{generar_codigo_verificacion()}_{nombre_limpio}"
-        
-        # 3. Guardar
+        nombre_limpio = SANITIZE_RE.sub('_', file.filename)
+
+        # 2. Crear nombre único (token_hex: sin riesgo de colisión entre uploads concurrentes)
+        nombre_archivo = f"{secrets.token_hex(4)}_{nombre_limpio}"
+
+        # 3. Guardar (readinto + memoryview: reutiliza un solo buffer, sin un bytes nuevo por chunk)
         ruta_guardado = os.path.join(UPLOAD_DIR, nombre_archivo)
-        with open(ruta_guardado, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
+        with open(ruta_guardado, "wb") as destino:
+            if hasattr(file.file, "readinto"):
+                buf = bytearray(UPLOAD_BUFSIZE)
+                mv = memoryview(buf)
+                while True:
+                    n = file.file.readinto(buf)
+                    if not n: break
+                    destino.write(mv[:n])
+            else:
+                shutil.copyfileobj(file.file, destino, length=UPLOAD_BUFSIZE)
+
         # 4. Devolver URL válida
         url_publica = f"https://servicios-api-4zmt.onrender.com/uploads/{nombre_archivo}"
         return {"url": url_publica}
-        
+
     except Exception as e:
         log.error(f"Error subiendo: {e}")
         raise HTTPException(500, "Error subiendo imagen")
-    
-    
+
+
+
+# El catálogo de oficios casi nunca cambia: cache en memoria + Cache-Control para el browser/CDN
+CATEGORIAS_TTL = 300
+_cat_cache = {"data": None, "ts": 0}
 
 @app.get("/categorias")
-def obtener_categorias():
-    conn = db_connections.get("pg_conn")
+async def obtener_categorias(response: Response):
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id, nombre, icono_url FROM categorias_oficios")
-            return [dict(cat) for cat in cursor.fetchall()]
+        ahora = time.time()
+        if _cat_cache["data"] is None or ahora - _cat_cache["ts"] > CATEGORIAS_TTL:
+            pool = await get_pool()
+            rows = await pool.fetch("SELECT id, nombre, icono_url FROM categorias_oficios")
+            _cat_cache["data"] = [dict(cat) for cat in rows]
+            _cat_cache["ts"] = ahora
+        response.headers["Cache-Control"] = f"public, max-age={CATEGORIAS_TTL}"
+        return _cat_cache["data"]
+    except HTTPException: raise
     except Exception: raise HTTPException(500, "Error")
 
 @app.post("/registro-cliente")
-def registrar_cliente(datos: RegistroCliente):
-    conn = db_connections.get("pg_conn")
-    if conn is None: raise HTTPException(503, "Sin BD")
+async def registrar_cliente(datos: RegistroCliente):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            hashed_pass = encriptar_password(datos.password)
+        async with pool.acquire() as conn:
+            hashed_pass = await encriptar_password_async(datos.password)
             codigo = generar_codigo_verificacion()
-            cursor.execute("INSERT INTO usuarios (nombre, apellidos, correo_electronico, password_hash, telefono, fecha_nacimiento, activo, codigo_verificacion) VALUES (%s, %s, %s, %s, %s, %s, TRUE, %s) RETURNING id", (datos.nombre, datos.apellidos, datos.correo_electronico, hashed_pass, datos.telefono, datos.fecha_nacimiento, codigo))
-            nuevo_id = cursor.fetchone()['id']
-            cursor.execute("INSERT INTO detalles_cliente (usuario_id, calle, colonia, numero_exterior, numero_interior, codigo_postal, ciudad, referencias_domicilio, latitud, longitud) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (nuevo_id, datos.calle, datos.colonia, datos.numero_exterior, datos.numero_interior, datos.codigo_postal, datos.ciudad, datos.referencias, datos.latitud, datos.longitud))
-            conn.commit()
+            async with conn.transaction():
+                nuevo_id = await conn.fetchval("INSERT INTO usuarios (nombre, apellidos, correo_electronico, password_hash, telefono, fecha_nacimiento, activo, codigo_verificacion) VALUES ($1, $2, $3, $4, $5, $6, TRUE, $7) RETURNING id", datos.nombre, datos.apellidos, datos.correo_electronico, hashed_pass, datos.telefono, datos.fecha_nacimiento, codigo)
+                await conn.execute("INSERT INTO detalles_cliente (usuario_id, calle, colonia, numero_exterior, numero_interior, codigo_postal, ciudad, referencias_domicilio, latitud, longitud) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)", nuevo_id, datos.calle, datos.colonia, datos.numero_exterior, datos.numero_interior, datos.codigo_postal, datos.ciudad, datos.referencias, datos.latitud, datos.longitud)
             print(f"\n===  CLIENTE: {datos.correo_electronico} | : {codigo} ===\n")
             return {"mensaje": "Cliente registrado.", "correo": datos.correo_electronico}
-    except psycopg2.IntegrityError: conn.rollback(); raise HTTPException(400, "Correo ya registrado.")
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, f"Error: {str(e)}")
+    except asyncpg.UniqueViolationError: raise HTTPException(400, "Correo ya registrado.")
+    except Exception as e: log.error(e); raise HTTPException(500, f"Error: {str(e)}")
 
 @app.post("/registro-trabajador")
-def registrar_trabajador(datos: RegistroTrabajador):
-    conn = db_connections.get("pg_conn")
-    if conn is None: raise HTTPException(503, "Sin BD")
+async def registrar_trabajador(datos: RegistroTrabajador):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            hashed_pass = encriptar_password(datos.password)
+        async with pool.acquire() as conn:
+            hashed_pass = await encriptar_password_async(datos.password)
             codigo = generar_codigo_verificacion()
-            cursor.execute("INSERT INTO usuarios (nombre, apellidos, correo_electronico, password_hash, telefono, fecha_nacimiento, activo, codigo_verificacion) VALUES (%s, %s, %s, %s, %s, %s, TRUE, %s) RETURNING id", (datos.nombre, datos.apellidos, datos.correo_electronico, hashed_pass, datos.telefono, datos.fecha_nacimiento, codigo))
-            nuevo_id = cursor.fetchone()['id']
-            cursor.execute("INSERT INTO detalles_trabajador (usuario_id, descripcion_bio, anios_experiencia, tarifa_hora_estimada, latitud, longitud) VALUES (%s, %s, %s, %s, %s, %s)", (nuevo_id, datos.descripcion_bio, datos.anios_experiencia, datos.tarifa_hora, datos.latitud, datos.longitud))
-            if datos.oficios_ids:
-                for oficio_id in datos.oficios_ids:
-                    cursor.execute("INSERT INTO trabajador_oficios (usuario_id, categoria_id) VALUES (%s, %s)", (nuevo_id, oficio_id))
-            conn.commit()
+            async with conn.transaction():
+                nuevo_id = await conn.fetchval("INSERT INTO usuarios (nombre, apellidos, correo_electronico, password_hash, telefono, fecha_nacimiento, activo, codigo_verificacion) VALUES ($1, $2, $3, $4, $5, $6, TRUE, $7) RETURNING id", datos.nombre, datos.apellidos, datos.correo_electronico, hashed_pass, datos.telefono, datos.fecha_nacimiento, codigo)
+                await conn.execute("INSERT INTO detalles_trabajador (usuario_id, descripcion_bio, anios_experiencia, tarifa_hora_estimada, latitud, longitud) VALUES ($1, $2, $3, $4, $5, $6)", nuevo_id, datos.descripcion_bio, datos.anios_experiencia, datos.tarifa_hora, datos.latitud, datos.longitud)
+                if datos.oficios_ids:
+                    # Un solo viaje a la BD para todos los oficios (antes era un INSERT por oficio)
+                    await conn.executemany("INSERT INTO trabajador_oficios (usuario_id, categoria_id) VALUES ($1, $2)", [(nuevo_id, oid) for oid in datos.oficios_ids])
             print(f"\n=== 📧 TRABAJADOR: {datos.correo_electronico} | 🔑: {codigo} ===\n")
             return {"mensaje": "Trabajador registrado.", "correo": datos.correo_electronico}
-    except psycopg2.IntegrityError: conn.rollback(); raise HTTPException(400, "Correo ya registrado.")
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, f"Error interno")
+    except asyncpg.UniqueViolationError: raise HTTPException(400, "Correo ya registrado.")
+    except Exception as e: log.error(e); raise HTTPException(500, f"Error interno")
 
 # ... (El inicio del archivo sigue igual) ...
 
 # --- ENDPOINT PAGO CORREGIDO ---
+# OJO: se queda como `def` a propósito — la SDK de Mercado Pago es HTTP bloqueante
+# y FastAPI la despacha al threadpool en vez de congelar el event loop
 @app.post("/pagos/crear-preferencia") # <--- 1. CORREGIDO EL NOMBRE
 def crear_preferencia_pago(datos: SolicitudPago):
-    if sdk is None:
+    if mp_preference is None:
         raise HTTPException(500, "Error: Mercado Pago no configurado.")
 
     print(f"💰 Creando preferencia para: {datos.titulo} - ${datos.precio}")
@@ -329,7 +484,7 @@ def crear_preferencia_pago(datos: SolicitudPago):
 
     try:
         # 3. Crear la preferencia
-        preference_response = sdk.preference().create(preference_data)
+        preference_response = mp_preference.create(preference_data)
 
         # Logs para ver qué pasa: imprimir la respuesta completa de MP
         print("\n--- RESPUESTA MP RAW ---")
@@ -351,8 +506,8 @@ def crear_preferencia_pago(datos: SolicitudPago):
 
             # Devolver 'init_point' (lo que tu HTML espera)
             return {
-                "preference_id": response_data.get("id"), 
-                "init_point": link_pago 
+                "preference_id": response_data.get("id"),
+                "init_point": link_pago
             }
         else:
             # Incluir la respuesta completa en el log y en el error para diagnóstico
@@ -365,42 +520,42 @@ def crear_preferencia_pago(datos: SolicitudPago):
         raise HTTPException(500, "Error procesando el pago.")
 
 # ... (El resto del archivo sigue igual) ...
-    
+
 @app.post("/verificar-cuenta")
-def verificar_cuenta(datos: DatosVerificacion):
-    conn = db_connections.get("pg_conn")
+async def verificar_cuenta(datos: DatosVerificacion):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id, codigo_verificacion, activo FROM usuarios WHERE correo_electronico = %s", (datos.correo,))
-            u = cursor.fetchone()
+        async with pool.acquire() as conn:
+            u = await conn.fetchrow("SELECT id, codigo_verificacion, activo FROM usuarios WHERE correo_electronico = $1", datos.correo)
             if not u: raise HTTPException(404, "Usuario no encontrado.")
             if u['activo']: return {"mensaje": "Cuenta ya activa."}
             if u['codigo_verificacion'] == datos.codigo:
-                cursor.execute("UPDATE usuarios SET activo = TRUE WHERE id = %s", (u['id'],))
-                conn.commit()
+                await conn.execute("UPDATE usuarios SET activo = TRUE WHERE id = $1", u['id'])
                 return {"mensaje": "¡Cuenta activada!"}
             else: raise HTTPException(400, "Código incorrecto.")
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, "Error interno.")
+    except HTTPException: raise
+    except Exception as e: log.error(e); raise HTTPException(500, "Error interno.")
 
 @app.post("/login")
-def login(datos: LoginRequest):
-    conn = db_connections.get("pg_conn")
+async def login(datos: LoginRequest):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id, nombre, password_hash, activo, es_admin, bloqueado_hasta FROM usuarios WHERE correo_electronico = %s", (datos.correo,))
-            u = cursor.fetchone()
-            if not u or not u['activo'] or not verificar_password(datos.password, u['password_hash']): 
-                raise HTTPException(401, "Credenciales incorrectas o inactiva.")
-            
-            if u['bloqueado_hasta']:
-                bloqueo = u['bloqueado_hasta'].replace(tzinfo=None) if u['bloqueado_hasta'].tzinfo else u['bloqueado_hasta']
-                if bloqueo > datetime.now(): raise HTTPException(403, "Cuenta bloqueada.")
-            
-            es_trabajador = False
-            cursor.execute("SELECT 1 FROM detalles_trabajador WHERE usuario_id = %s", (u['id'],))
-            if cursor.fetchone(): es_trabajador = True
-
-            return {"mensaje": "Login exitoso", "usuario": {"id": str(u['id']), "nombre": u['nombre'], "es_admin": u['es_admin'], "es_trabajador": es_trabajador}}
+        if login_bloqueado(datos.correo): raise HTTPException(429, "Demasiados intentos. Espera un momento.")
+        u = await pool.fetchrow(LOGIN_SQL, datos.correo)
+        # Cortocircuito: sin usuario o cuenta inactiva no se corre bcrypt
+        if not u or not u['activo']:
+            raise HTTPException(401, "Credenciales incorrectas o inactiva.")
+        if not await verificar_password_async(datos.password, u['password_hash']):
+            login_fallido(datos.correo)
+            raise HTTPException(401, "Credenciales incorrectas o inactiva.")
+        _intentos_login.pop(datos.correo, None)
+
+        if u['bloqueado_hasta']:
+            bloqueo = u['bloqueado_hasta'].replace(tzinfo=None) if u['bloqueado_hasta'].tzinfo else u['bloqueado_hasta']
+            if bloqueo > datetime.now(): raise HTTPException(403, "Cuenta bloqueada.")
+
+        return {"mensaje": "Login exitoso", "usuario": {"id": str(u['id']), "nombre": u['nombre'], "es_admin": u['es_admin'], "es_trabajador": u['es_trabajador']}}
+    except HTTPException: raise
     except Exception as e: log.error(e); raise HTTPException(500, "Error interno")
 
 # ==========================================
@@ -410,276 +565,299 @@ def login(datos: LoginRequest):
 
 # --- ENDPOINT GET (Sin pedir dirección) ---
 @app.get("/mi-perfil/{usuario_id}")
-def obtener_perfil_trabajador(usuario_id: str):
-    conn = db_connections.get("pg_conn")
+async def obtener_perfil_trabajador(usuario_id: str):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            # Solo traemos lo que existe en tu BD
-            cursor.execute("""
-                SELECT u.nombre, u.apellidos, u.telefono, u.foto_perfil_url,
-                       dt.descripcion_bio, dt.anios_experiencia, dt.tarifa_hora_estimada, 
-                       dt.calificacion_promedio, dt.total_evaluaciones, dt.validado_por_admin,
-                       dt.foto_ine_frente_url, dt.foto_ine_reverso_url, dt.antecedentes_penales_url
-                FROM usuarios u
-                JOIN detalles_trabajador dt ON u.id = dt.usuario_id
-                WHERE u.id = %s
-            """, (usuario_id,))
-            perfil = cursor.fetchone()
-            if not perfil: raise HTTPException(404, "Perfil no encontrado")
-            return dict(perfil)
+        # Solo traemos lo que existe en tu BD
+        perfil = await pool.fetchrow(PERFIL_TRAB_SQL, usuario_id)
+        if not perfil: raise HTTPException(404, "Perfil no encontrado")
+        return dict(perfil)
+    except HTTPException: raise
     except Exception as e: log.error(e); raise HTTPException(500, "Error interno")
 
 
 # --- ENDPOINT PUT (Sin actualizar dirección) ---
 @app.put("/mi-perfil/{usuario_id}")
-def actualizar_perfil_trabajador(usuario_id: str, datos: PerfilTrabajadorUpdate):
-    conn = db_connections.get("pg_conn")
+async def actualizar_perfil_trabajador(usuario_id: str, datos: PerfilTrabajadorUpdate):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            # 1. Actualizar tabla usuarios (Nombre, Teléfono, Foto Perfil)
-            cursor.execute("""
-                UPDATE usuarios 
-                SET nombre=%s, apellidos=%s, telefono=%s, foto_perfil_url=%s 
-                WHERE id=%s
-            """, (datos.nombre, datos.apellidos, datos.telefono, datos.foto_perfil_url, usuario_id))
-            
-            # 2. Actualizar tabla detalles_trabajador (Bio, Experiencia, Tarifa, Docs)
-            cursor.execute("""
-                UPDATE detalles_trabajador SET 
-                    descripcion_bio=%s, anios_experiencia=%s, tarifa_hora_estimada=%s,
-                    foto_ine_frente_url=%s, foto_ine_reverso_url=%s, antecedentes_penales_url=%s
-                WHERE usuario_id=%s
-            """, (
-                datos.descripcion_bio, datos.anios_experiencia, datos.tarifa_hora,
-                datos.foto_ine_frente_url, datos.foto_ine_reverso_url, datos.antecedentes_penales_url, 
-                usuario_id
-            ))
-            conn.commit()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # 1. Actualizar tabla usuarios (Nombre, Teléfono, Foto Perfil)
+                await conn.execute("""
+                    UPDATE usuarios
+                    SET nombre=$1, apellidos=$2, telefono=$3, foto_perfil_url=$4
+                    WHERE id=$5
+                """, datos.nombre, datos.apellidos, datos.telefono, datos.foto_perfil_url, usuario_id)
+
+                # 2. Actualizar tabla detalles_trabajador (Bio, Experiencia, Tarifa, Docs)
+                await conn.execute("""
+                    UPDATE detalles_trabajador SET
+                        descripcion_bio=$1, anios_experiencia=$2, tarifa_hora_estimada=$3,
+                        foto_ine_frente_url=$4, foto_ine_reverso_url=$5, antecedentes_penales_url=$6
+                    WHERE usuario_id=$7
+                """, datos.descripcion_bio, datos.anios_experiencia, datos.tarifa_hora,
+                    datos.foto_ine_frente_url, datos.foto_ine_reverso_url, datos.antecedentes_penales_url,
+                    usuario_id)
             return {"mensaje": "Perfil actualizado correctamente"}
-    except Exception as e: 
-        conn.rollback()
+    except Exception as e:
         log.error(e)
         raise HTTPException(500, "Error al actualizar perfil")
-    
+
 @app.get("/mi-perfil-cliente/{usuario_id}")
-def get_perfil_cliente(usuario_id: str):
-    conn = db_connections.get("pg_conn")
+async def get_perfil_cliente(usuario_id: str):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT u.nombre, u.apellidos, u.telefono, u.correo_electronico, u.foto_perfil_url, u.fecha_nacimiento,
-                       dc.calle, dc.colonia, dc.codigo_postal, dc.ciudad, 
-                       dc.numero_exterior, dc.numero_interior, dc.referencias_domicilio,
-                       dc.latitud, dc.longitud
-                FROM usuarios u
-                JOIN detalles_cliente dc ON u.id = dc.usuario_id
-                WHERE u.id = %s
-            """, (usuario_id,))
-            p = cur.fetchone()
-            if not p: raise HTTPException(404, "Perfil no encontrado")
-            return dict(p)
+        p = await pool.fetchrow("""
+            SELECT u.nombre, u.apellidos, u.telefono, u.correo_electronico, u.foto_perfil_url, u.fecha_nacimiento,
+                   dc.calle, dc.colonia, dc.codigo_postal, dc.ciudad,
+                   dc.numero_exterior, dc.numero_interior, dc.referencias_domicilio,
+                   dc.latitud, dc.longitud
+            FROM usuarios u
+            JOIN detalles_cliente dc ON u.id = dc.usuario_id
+            WHERE u.id = $1
+        """, usuario_id)
+        if not p: raise HTTPException(404, "Perfil no encontrado")
+        return dict(p)
+    except HTTPException: raise
     except Exception as e: log.error(e); raise HTTPException(500, "Error")
 
 @app.put("/mi-perfil-cliente/{usuario_id}")
-def update_perfil_cliente(usuario_id: str, d: PerfilClienteUpdate):
-    conn = db_connections.get("pg_conn")
+async def update_perfil_cliente(usuario_id: str, d: PerfilClienteUpdate):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cur:
-            if d.password_nuevo:
-                h = encriptar_password(d.password_nuevo)
-                cur.execute("UPDATE usuarios SET nombre=%s, apellidos=%s, telefono=%s, correo_electronico=%s, foto_perfil_url=%s, password_hash=%s WHERE id=%s", (d.nombre, d.apellidos, d.telefono, d.correo_electronico, d.foto_perfil_url, h, usuario_id))
-            else:
-                cur.execute("UPDATE usuarios SET nombre=%s, apellidos=%s, telefono=%s, correo_electronico=%s, foto_perfil_url=%s WHERE id=%s", (d.nombre, d.apellidos, d.telefono, d.correo_electronico, d.foto_perfil_url, usuario_id))
-
-            cur.execute("""
-                UPDATE detalles_cliente 
-                SET calle=%s, colonia=%s, codigo_postal=%s, ciudad=%s, numero_exterior=%s, numero_interior=%s, referencias_domicilio=%s, latitud=%s, longitud=%s
-                WHERE usuario_id=%s
-            """, (d.calle, d.colonia, d.codigo_postal, d.ciudad, d.numero_exterior, d.numero_interior, d.referencias, d.latitud, d.longitud, usuario_id))
-            conn.commit()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if d.password_nuevo:
+                    h = await encriptar_password_async(d.password_nuevo)
+                    await conn.execute("UPDATE usuarios SET nombre=$1, apellidos=$2, telefono=$3, correo_electronico=$4, foto_perfil_url=$5, password_hash=$6 WHERE id=$7", d.nombre, d.apellidos, d.telefono, d.correo_electronico, d.foto_perfil_url, h, usuario_id)
+                else:
+                    await conn.execute("UPDATE usuarios SET nombre=$1, apellidos=$2, telefono=$3, correo_electronico=$4, foto_perfil_url=$5 WHERE id=$6", d.nombre, d.apellidos, d.telefono, d.correo_electronico, d.foto_perfil_url, usuario_id)
+
+                await conn.execute("""
+                    UPDATE detalles_cliente
+                    SET calle=$1, colonia=$2, codigo_postal=$3, ciudad=$4, numero_exterior=$5, numero_interior=$6, referencias_domicilio=$7, latitud=$8, longitud=$9
+                    WHERE usuario_id=$10
+                """, d.calle, d.colonia, d.codigo_postal, d.ciudad, d.numero_exterior, d.numero_interior, d.referencias, d.latitud, d.longitud, usuario_id)
             return {"mensaje": "Perfil actualizado"}
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, "Error update")
+    except Exception as e: log.error(e); raise HTTPException(500, "Error update")
 
 # ==========================================
 # 7. ENDPOINTS: SERVICIOS Y PROPUESTAS
 # ==========================================
 
 @app.post("/servicios")
-def crear_servicio(datos: CrearServicio):
-    conn = db_connections.get("pg_conn")
+async def crear_servicio(datos: CrearServicio):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO servicios (cliente_id, categoria_id, titulo, descripcion, fecha_programada, precio_estimado, direccion_texto, latitud, longitud, foto_evidencia_url)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
-            """, (datos.cliente_id, datos.categoria_id, datos.titulo, datos.descripcion, datos.fecha_programada, datos.precio_estimado, datos.direccion_texto, datos.latitud, datos.longitud, datos.foto_evidencia_url))
-            nid = cursor.fetchone()['id']
-            conn.commit()
-            return {"mensaje": "Solicitud creada", "servicio_id": str(nid)}
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, "Error crear servicio")
+        nid = await pool.fetchval("""
+            INSERT INTO servicios (cliente_id, categoria_id, titulo, descripcion, fecha_programada, precio_estimado, direccion_texto, latitud, longitud, foto_evidencia_url)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10) RETURNING id
+        """, datos.cliente_id, datos.categoria_id, datos.titulo, datos.descripcion, datos.fecha_programada, datos.precio_estimado, datos.direccion_texto, datos.latitud, datos.longitud, datos.foto_evidencia_url)
+        return {"mensaje": "Solicitud creada", "servicio_id": str(nid)}
+    except Exception as e: log.error(e); raise HTTPException(500, "Error crear servicio")
 
 @app.get("/servicios/{usuario_id}")
-def listar_servicios_cliente(usuario_id: str):
-    conn = db_connections.get("pg_conn")
+async def listar_servicios_cliente(usuario_id: str):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT s.id, s.titulo, s.estado, s.fecha_solicitud, c.nombre as categoria,
-                       (SELECT COUNT(*) FROM propuestas p WHERE p.servicio_id = s.id) as num_propuestas
-                FROM servicios s
-                JOIN categorias_oficios c ON s.categoria_id = c.id
-                WHERE s.cliente_id = %s
-                ORDER BY s.fecha_solicitud DESC
-            """, (usuario_id,))
-            res = []
-            for s in cur.fetchall():
-                d = dict(s)
-                d['id'] = str(d['id'])
-                d['fecha_solicitud'] = str(d['fecha_solicitud'])
-                res.append(d)
-            return res
+        rows = await pool.fetch(SERVICIOS_CLIENTE_SQL, usuario_id)
+        return [dict(s) for s in rows]
     except Exception as e: log.error(e); raise HTTPException(500, "Error servicios")
 
 @app.get("/feed-servicios")
-def feed_servicios():
-    conn = db_connections.get("pg_conn")
+async def feed_servicios():
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT s.id, s.titulo, s.descripcion, s.precio_estimado, s.fecha_programada, s.direccion_texto, s.foto_evidencia_url,
-                       c.nombre as categoria, u.nombre as cliente_nombre
-                FROM servicios s
-                JOIN categorias_oficios c ON s.categoria_id = c.id
-                JOIN usuarios u ON s.cliente_id = u.id
-                WHERE s.estado = 'SOLICITADO'
-                ORDER BY s.fecha_solicitud DESC LIMIT 20
-            """)
-            servicios = cursor.fetchall()
-            res = []
-            for s in servicios:
-                d = dict(s)
-                d['id'] = str(d['id'])
-                d['fecha_programada'] = str(d['fecha_programada'])
-                res.append(d)
-            return res
+        servicios = await pool.fetch(FEED_SQL)
+        return [dict(s) for s in servicios]
     except Exception as e: log.error(e); raise HTTPException(500, "Error feed")
 
 @app.post("/propuestas")
-def crear_propuesta(datos: CrearPropuesta):
-    conn = db_connections.get("pg_conn")
+async def crear_propuesta(datos: CrearPropuesta):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT 1 FROM propuestas WHERE servicio_id = %s AND trabajador_id = %s", (datos.servicio_id, datos.trabajador_id))
-            if cursor.fetchone(): raise HTTPException(400, "Ya te has postulado.")
-            cursor.execute("INSERT INTO propuestas (servicio_id, trabajador_id, precio_oferta, mensaje) VALUES (%s, %s, %s, %s)", (datos.servicio_id, datos.trabajador_id, datos.precio_oferta, datos.mensaje))
-            conn.commit()
-            return {"mensaje": "Propuesta enviada"}
+        # ON CONFLICT sobre el índice único: un solo viaje y sin carrera SELECT/INSERT
+        nid = await pool.fetchval("""
+            INSERT INTO propuestas (servicio_id, trabajador_id, precio_oferta, mensaje)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (servicio_id, trabajador_id) DO NOTHING
+            RETURNING id
+        """, datos.servicio_id, datos.trabajador_id, datos.precio_oferta, datos.mensaje)
+        if nid is None: raise HTTPException(400, "Ya te has postulado.")
+        return {"mensaje": "Propuesta enviada"}
     except HTTPException as e: raise e
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, "Error propuesta")
+    except Exception as e: log.error(e); raise HTTPException(500, "Error propuesta")
 
 @app.get("/servicios/{servicio_id}/propuestas")
-def ver_propuestas(servicio_id: str):
-    conn = db_connections.get("pg_conn")
+async def ver_propuestas(servicio_id: str):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cur:
-            # TRAEMOS DATOS COMPLETOS DEL TRABAJADOR
-            cur.execute("""
-                SELECT p.id, p.precio_oferta, p.mensaje, p.trabajador_id,
-                       u.nombre, u.apellidos, u.foto_perfil_url, u.telefono,
-                       dt.calificacion_promedio, dt.total_evaluaciones,
-                       dt.anios_experiencia, dt.descripcion_bio
-                FROM propuestas p
-                JOIN usuarios u ON p.trabajador_id = u.id
-                JOIN detalles_trabajador dt ON u.id = dt.usuario_id
-                WHERE p.servicio_id = %s
-                ORDER BY p.precio_oferta ASC
-            """, (servicio_id,))
-            
-            # Convertimos a lista de diccionarios
-            resultados = []
-            for row in cur.fetchall():
-                d = dict(row)
-                d['id'] = str(d['id'])
-                d['trabajador_id'] = str(d['trabajador_id'])
-                # Convertimos decimales a float para que JS no falle
-                if d['calificacion_promedio']: d['calificacion_promedio'] = float(d['calificacion_promedio'])
-                if d['precio_oferta']: d['precio_oferta'] = float(d['precio_oferta'])
-                resultados.append(d)
-            return resultados
-
-    except Exception as e: 
+        # TRAEMOS DATOS COMPLETOS DEL TRABAJADOR
+        # Los codecs del pool ya entregan uuid como str y numeric como float
+        rows = await pool.fetch(PROPUESTAS_SQL, servicio_id)
+        return [dict(r) for r in rows]
+
+    except Exception as e:
         log.error(e)
         raise HTTPException(500, "Error cargando propuestas")
 
 @app.post("/servicios/contratar")
-def contratar_trabajador(datos: AceptarPropuesta):
-    conn = db_connections.get("pg_conn")
+async def contratar_trabajador(datos: AceptarPropuesta):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE servicios SET trabajador_id = %s, estado = 'EN_PROCESO', precio_estimado = (SELECT precio_oferta FROM propuestas WHERE id = %s) WHERE id = %s", (datos.trabajador_id, datos.propuesta_id, datos.servicio_id))
-            cursor.execute("UPDATE propuestas SET aceptada = TRUE WHERE id = %s", (datos.propuesta_id,))
-            conn.commit()
-            return {"mensaje": "¡Contratado!"}
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, "Error contratar")
+        # Los dos UPDATEs fusionados en un solo statement atómico
+        await pool.execute("""
+            WITH upd_serv AS (
+                UPDATE servicios SET trabajador_id = $1, estado = 'EN_PROCESO',
+                       precio_estimado = (SELECT precio_oferta FROM propuestas WHERE id = $2)
+                WHERE id = $3 RETURNING id
+            )
+            UPDATE propuestas SET aceptada = TRUE WHERE id = $2
+        """, datos.trabajador_id, datos.propuesta_id, datos.servicio_id)
+        return {"mensaje": "¡Contratado!"}
+    except Exception as e: log.error(e); raise HTTPException(500, "Error contratar")
 
 @app.get("/trabajador/mis-trabajos/{trabajador_id}")
-def mis_trabajos_trabajador(trabajador_id: str):
-    conn = db_connections.get("pg_conn")
+async def mis_trabajos_trabajador(trabajador_id: str):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            # CORRECCIÓN: Agregamos s.calificacion y s.resena
-            cursor.execute("""
-                SELECT s.id, s.titulo, s.descripcion, s.estado, s.fecha_solicitud, s.direccion_texto, 
-                       s.precio_estimado, s.calificacion, s.resena,
-                       u.nombre as cliente_nombre, u.telefono as cliente_telefono
-                FROM servicios s
-                JOIN usuarios u ON s.cliente_id = u.id
-                WHERE s.trabajador_id = %s
-                ORDER BY s.fecha_solicitud DESC
-            """, (trabajador_id,))
-            return [dict(s, id=str(s['id']), fecha_solicitud=str(s['fecha_solicitud'])) for s in cursor.fetchall()]
+        # CORRECCIÓN: Agregamos s.calificacion y s.resena
+        rows = await pool.fetch("""
+            SELECT s.id, s.titulo, s.descripcion, s.estado, s.fecha_solicitud, s.direccion_texto,
+                   s.precio_estimado, s.calificacion, s.resena,
+                   u.nombre as cliente_nombre, u.telefono as cliente_telefono
+            FROM servicios s
+            JOIN usuarios u ON s.cliente_id = u.id
+            WHERE s.trabajador_id = $1
+            ORDER BY s.fecha_solicitud DESC
+        """, trabajador_id)
+        return [dict(s) for s in rows]
     except Exception as e: log.error(e); raise HTTPException(500, "Error")
 
 @app.post("/servicios/finalizar")
-def finalizar_servicio(datos: CalificarServicio):
-    conn = db_connections.get("pg_conn")
+async def finalizar_servicio(datos: CalificarServicio):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE servicios SET estado = 'TERMINADO', calificacion = %s, resena = %s WHERE id = %s RETURNING trabajador_id", (datos.calificacion, datos.resena, datos.servicio_id))
-            res = cursor.fetchone()
-            if not res: raise HTTPException(404, "Servicio no encontrado")
-            tid = res['trabajador_id']
-            cursor.execute("SELECT AVG(calificacion) as pro, COUNT(*) as tot FROM servicios WHERE trabajador_id = %s AND calificacion IS NOT NULL", (tid,))
-            stats = cursor.fetchone()
-            cursor.execute("UPDATE detalles_trabajador SET calificacion_promedio = %s, total_evaluaciones = %s WHERE usuario_id = %s", (float(stats['pro'] or 0), int(stats['tot']), tid))
-            conn.commit()
-            return {"mensaje": "Finalizado y calificado"}
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, "Error finalizar")
+        # Un solo statement atómico: cerrar servicio, recalcular promedio y actualizar al trabajador.
+        # OJO: los CTEs de un WITH ven el mismo snapshot, así que agg NO ve el UPDATE de upd;
+        # por eso excluimos el servicio ($3) del agregado y sumamos la calificación nueva ($1) aparte
+        sid = await pool.fetchval("""
+            WITH upd AS (
+                UPDATE servicios SET estado = 'TERMINADO', calificacion = $1, resena = $2
+                WHERE id = $3 RETURNING id, trabajador_id
+            ), agg AS (
+                SELECT AVG(c)::float AS pro, COUNT(*) AS tot
+                FROM (
+                    SELECT calificacion AS c FROM servicios
+                    WHERE trabajador_id = (SELECT trabajador_id FROM upd) AND id <> $3 AND calificacion IS NOT NULL
+                    UNION ALL
+                    SELECT $1
+                ) califs
+            ), upd_dt AS (
+                UPDATE detalles_trabajador dt
+                SET calificacion_promedio = COALESCE((SELECT pro FROM agg), 0),
+                    total_evaluaciones    = (SELECT tot FROM agg)
+                WHERE usuario_id = (SELECT trabajador_id FROM upd)
+                RETURNING usuario_id
+            )
+            SELECT (SELECT id FROM upd)
+        """, datos.calificacion, datos.resena, datos.servicio_id)
+        if sid is None: raise HTTPException(404, "Servicio no encontrado")
+        return {"mensaje": "Finalizado y calificado"}
+    except HTTPException: raise
+    except Exception as e: log.error(e); raise HTTPException(500, "Error finalizar")
 
 # ==========================================
 # 8. ADMIN
 # ==========================================
+# Espera máxima por una conexión del pool: mejor un 500 rápido que una cola infinita
+ADMIN_ACQUIRE_TIMEOUT = 2.0
+
+# Texto fijo por acción: el cache de prepared statements del pool los prepara una vez por conexión.
+# RETURNING nos dice en el mismo viaje si el usuario existía (antes un id inexistente "triunfaba")
+SQL_VALIDAR = "UPDATE detalles_trabajador SET validado_por_admin = TRUE WHERE usuario_id = $1 RETURNING usuario_id"
+# El fin del bloqueo se calcula con el reloj de la BD (consistente entre workers/zonas horarias)
+SQL_BLOQUEAR = "UPDATE usuarios SET bloqueado_hasta = NOW() + make_interval(days => $1) WHERE id = $2 RETURNING id"
+SQL_DESBLOQUEAR = "UPDATE usuarios SET bloqueado_hasta = NULL WHERE id = $1 RETURNING id"
+SQL_BORRAR = "DELETE FROM usuarios WHERE id = $1 RETURNING id"
+
+# Despacho por tabla: (sql, armar_params); las acciones válidas las garantiza el Literal del modelo
+ACCIONES_ADMIN = {
+    "validar": (SQL_VALIDAR, lambda d: (d.usuario_id,)),
+    "bloquear": (SQL_BLOQUEAR, lambda d: (d.dias_bloqueo or 36500, d.usuario_id)),
+    "desbloquear": (SQL_DESBLOQUEAR, lambda d: (d.usuario_id,)),
+    "borrar": (SQL_BORRAR, lambda d: (d.usuario_id,)),
+}
+
+# Cache corto del listado (el join de 3 tablas casi no cambia entre refrescos del panel);
+# cada acción de admin lo invalida al instante. Se guarda el JSON ya serializado:
+# un hit de cache devuelve bytes tal cual, sin re-codificar fila por fila
+ADMIN_USUARIOS_TTL = int(os.environ.get("ADMIN_USUARIOS_TTL", 20))
+ADMIN_USUARIOS_LIMIT = 100
+_admin_usuarios_cache = {"data": None, "next": None, "ts": 0}
+
+# LATERAL con LIMIT 1: en cuanto una tabla de detalles responde, no se prueba la otra.
+# Paginación keyset por (fecha_registro, id): costo constante sin importar cuántos usuarios haya
+_ADMIN_USUARIOS_BASE = """
+    SELECT u.id::text as id, u.nombre, u.apellidos, u.correo_electronico, u.activo,
+           u.bloqueado_hasta::text as bloqueado_hasta,
+           u.fecha_registro::text as fecha_registro,
+           COALESCE(r.rol, CASE WHEN u.es_admin THEN 'Admin' ELSE 'Desconocido' END) as rol,
+           r.validado_por_admin
+    FROM usuarios u
+    LEFT JOIN LATERAL (
+        SELECT 'Trabajador' AS rol, dt.validado_por_admin FROM detalles_trabajador dt WHERE dt.usuario_id = u.id
+        UNION ALL
+        SELECT 'Cliente', NULL FROM detalles_cliente dc WHERE dc.usuario_id = u.id
+        LIMIT 1
+    ) r ON TRUE
+    {filtro}
+    ORDER BY u.fecha_registro DESC, u.id DESC
+    LIMIT {limite}
+"""
+ADMIN_USUARIOS_SQL = _ADMIN_USUARIOS_BASE.format(filtro="", limite="$1")
+ADMIN_USUARIOS_PAGINA_SQL = _ADMIN_USUARIOS_BASE.format(
+    filtro="WHERE (u.fecha_registro, u.id) < ($1::timestamptz, $2::uuid)", limite="$3")
+
 @app.get("/admin/usuarios")
-def admin_listar_usuarios():
-    conn = db_connections.get("pg_conn")
+async def admin_listar_usuarios(limit: int = Query(ADMIN_USUARIOS_LIMIT, ge=1, le=500), cursor: Optional[str] = None):
+    # Solo la primera página default se cachea (es lo que carga el panel)
+    usar_cache = cursor is None and limit == ADMIN_USUARIOS_LIMIT
+    if usar_cache and _admin_usuarios_cache["data"] is not None and time.time() - _admin_usuarios_cache["ts"] <= ADMIN_USUARIOS_TTL:
+        headers = {"X-Next-Cursor": _admin_usuarios_cache["next"]} if _admin_usuarios_cache["next"] else None
+        return Response(_admin_usuarios_cache["data"], media_type="application/json", headers=headers)
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""SELECT u.id, u.nombre, u.apellidos, u.correo_electronico, u.activo, u.bloqueado_hasta, CASE WHEN dt.usuario_id IS NOT NULL THEN 'Trabajador' WHEN dc.usuario_id IS NOT NULL THEN 'Cliente' WHEN u.es_admin THEN 'Admin' ELSE 'Desconocido' END as rol, dt.validado_por_admin FROM usuarios u LEFT JOIN detalles_trabajador dt ON u.id = dt.usuario_id LEFT JOIN detalles_cliente dc ON u.id = dc.usuario_id ORDER BY u.fecha_registro DESC""")
-            return [dict(u, id=str(u['id']), bloqueado_hasta=str(u['bloqueado_hasta']) if u['bloqueado_hasta'] else None) for u in cursor.fetchall()]
+        async with pool.acquire(timeout=ADMIN_ACQUIRE_TIMEOUT) as conn:
+            if cursor:
+                fecha_txt, _, id_txt = cursor.partition("|")
+                if not id_txt: raise HTTPException(400, "Cursor inválido")
+                try: rows = await conn.fetch(ADMIN_USUARIOS_PAGINA_SQL, fecha_txt, id_txt, limit)
+                except asyncpg.DataError: raise HTTPException(400, "Cursor inválido")  # fecha/uuid que no castea
+            else:
+                rows = await conn.fetch(ADMIN_USUARIOS_SQL, limit)
+            siguiente = f"{rows[-1]['fecha_registro']}|{rows[-1]['id']}" if len(rows) == limit else None
+            # Los casts vienen hechos de SQL: ya no hay que reescribir cada fila en Python
+            cuerpo = orjson.dumps([dict(u) for u in rows])
+            if usar_cache:
+                _admin_usuarios_cache["data"] = cuerpo
+                _admin_usuarios_cache["next"] = siguiente
+                _admin_usuarios_cache["ts"] = time.time()
+            headers = {"X-Next-Cursor": siguiente} if siguiente else None
+            return Response(cuerpo, media_type="application/json", headers=headers)
+    except HTTPException: raise
     except Exception as e: log.error(e); raise HTTPException(500, "Error listando")
 
 @app.post("/admin/accion")
-def admin_accion_usuario(datos: AccionAdmin):
-    conn = db_connections.get("pg_conn")
+async def admin_accion_usuario(datos: AccionAdmin):
+    pool = await get_pool()
     try:
-        with conn.cursor() as cursor:
-            if datos.accion == "validar": cursor.execute("UPDATE detalles_trabajador SET validado_por_admin = TRUE WHERE usuario_id = %s", (datos.usuario_id,))
-            elif datos.accion == "bloquear":
-                dias = datos.dias_bloqueo if datos.dias_bloqueo else 36500
-                fecha_fin = datetime.now() + timedelta(days=dias)
-                cursor.execute("UPDATE usuarios SET bloqueado_hasta = %s WHERE id = %s", (fecha_fin, datos.usuario_id))
-            elif datos.accion == "desbloquear": cursor.execute("UPDATE usuarios SET bloqueado_hasta = NULL WHERE id = %s", (datos.usuario_id,))
-            elif datos.accion == "borrar": cursor.execute("DELETE FROM usuarios WHERE id = %s", (datos.usuario_id,))
-            conn.commit()
+        async with pool.acquire(timeout=ADMIN_ACQUIRE_TIMEOUT) as conn:
+            sql, armar_params = ACCIONES_ADMIN[datos.accion]
+            fila = await conn.fetchval(sql, *armar_params(datos))
+            if fila is None: raise HTTPException(404, "Usuario no encontrado.")
+            _admin_usuarios_cache["data"] = None  # que el siguiente listado vea el cambio
             return {"mensaje": f"Acción '{datos.accion}' ejecutada."}
-    except Exception as e: conn.rollback(); log.error(e); raise HTTPException(500, f"Error: {str(e)}")
\ No newline at end of file
+    except HTTPException: raise
+    except Exception as e: log.error(e); raise HTTPException(500, "Error ejecutando acción")
@@ -156,8 +156,24 @@ CREATE TABLE propuestas (
 -- ==========================================
 -- 8. ÍNDICES
 -- ==========================================
-CREATE INDEX IF NOT EXISTS idx_correo ON usuarios (correo_electronico);
-CREATE INDEX IF NOT EXISTS idx_servicios_cliente ON servicios(cliente_id);
+-- Nota: usuarios(correo_electronico) ya tiene índice por su UNIQUE,
+-- y detalles_trabajador(usuario_id) es PRIMARY KEY.
+
+-- Listado del cliente: WHERE cliente_id ... ORDER BY fecha_solicitud DESC
+CREATE INDEX IF NOT EXISTS idx_servicios_cliente_fecha ON servicios(cliente_id, fecha_solicitud DESC);
 CREATE INDEX IF NOT EXISTS idx_servicios_trabajador ON servicios(trabajador_id);
-CREATE INDEX IF NOT EXISTS idx_servicios_estado ON servicios(estado);
-CREATE INDEX IF NOT EXISTS idx_propuestas_servicio ON propuestas(servicio_id);
\ No newline at end of file
+
+-- Feed: índice parcial, solo consulta estado='SOLICITADO'
+CREATE INDEX IF NOT EXISTS idx_servicios_feed ON servicios(fecha_solicitud DESC) WHERE estado = 'SOLICITADO';
+
+-- Propuestas: listado ordenado por precio + chequeo de duplicados
+CREATE INDEX IF NOT EXISTS idx_propuestas_servicio_precio ON propuestas(servicio_id, precio_oferta);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_propuestas_servicio_trab ON propuestas(servicio_id, trabajador_id);
+
+-- Listado de admin: ORDER BY fecha_registro DESC sin sort, y probes index-only
+-- sobre detalles_trabajador (la PK no cubre validado_por_admin; detalles_cliente
+-- solo se consulta por existencia, su PK basta)
+CREATE INDEX IF NOT EXISTS idx_usuarios_fecha_registro ON usuarios(fecha_registro DESC)
+    INCLUDE (id, nombre, apellidos, correo_electronico, activo, bloqueado_hasta, es_admin);
+CREATE INDEX IF NOT EXISTS idx_dt_usuario_validado ON detalles_trabajador(usuario_id)
+    INCLUDE (validado_por_admin);
\ No newline at end of file